@@ -4,9 +4,36 @@
 Manipulate PSARC archives used by Rocksmith 2014.
 
 Usage:
-    psarc.py pack DIRECTORY...
-    psarc.py unpack FILE...
-    psarc.py convert FILE...
+    psarc.py pack [--jobs N] [--compression PROFILE] [--incremental]
+                  [--dedup] [--adaptive] DIRECTORY...
+    psarc.py unpack [--jobs N] [--processes N] [--include GLOB]...
+                    [--exclude GLOB]... [--stats FORMAT] [--preallocate]
+                    FILE...
+    psarc.py convert [--jobs N] [--compression PROFILE] FILE...
+    psarc.py ls FILE...
+    psarc.py stat FILE...
+    psarc.py verify [--jobs N] FILE...
+    psarc.py diff [--jobs N] FILE FILE
+    psarc.py serve [--port N] [--cache MB] DIR
+
+Options:
+    -j N, --jobs N       Number of worker threads [default: 1]
+    -p N, --processes N  Number of archives extracted in parallel [default: 1]
+    --include GLOB       Only extract entries matching GLOB, ** spans folders
+    --exclude GLOB       Skip entries matching GLOB
+    --stats FORMAT       Print per stage statistics instead of progress,
+                         as json
+    --preallocate        Spread the blocks of all entries across jobs,
+                         inflated into preallocated memory mapped files
+    --port N             Port of the HTTP server [default: 8080]
+    --cache MB           Size of the decoded block cache [default: 64]
+    -c PROFILE, --compression PROFILE
+                         best, default, fast or store [default: best]
+    --incremental        Reuse unchanged entries of the existing archive
+    --dedup              Store identical files once
+    --adaptive           Store blocks raw, without compressing them, when
+                         their extension or a trial on a sample shows they
+                         would not shrink
 """
 
 from Crypto.Cipher import AES
@@ -18,19 +45,44 @@ import os
 import hashlib
 import sys
 import json
+import mmap
+import array
+import collections
+import time
+import re
+import threading
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed
 
 import codecs
+import functools
+import itertools
+import errno
+import tempfile
 
 import sys
-print("psarc.py running on Python version %s.%s" % (sys.version_info.major,sys.version_info.minor))
+sys.stderr.write("psarc.py running on Python version %s.%s\n" % (sys.version_info.major,sys.version_info.minor))
 
-MAGIC = "PSAR"
+MAGIC = b"PSAR"
 VERSION = 65540
-COMPRESSION = "zlib"
+COMPRESSION = b"zlib"
 ARCHIVE_FLAGS = 4
 ENTRY_SIZE = 30
 BLOCK_SIZE = 65536
 
+# zlib levels of the compression profiles used when packing
+PROFILES = {
+    'best': zlib.Z_BEST_COMPRESSION,
+    'default': zlib.Z_DEFAULT_COMPRESSION,
+    'fast': zlib.Z_BEST_SPEED,
+    'store': zlib.Z_NO_COMPRESSION
+}
+
+# Already compressed formats, stored raw by adaptive packing
+STORED_EXTENSIONS = ('.wem', '.bnk')
+
 ARC_KEY = 'C53DB23870A1A2F71CAE64061FDD0E1157309DC85204D4C5BFDF25090DF2572C'
 ARC_IV = 'E915AA018FEF71FC508132E4BB4CEB42'
 
@@ -53,6 +105,14 @@ def pad(data, blocksize=16):
     return data + bytes(padding)
 
 
+def walk_directory(path):
+    """Yields (name, fullpath) for every file below a path"""
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            fullpath = os.path.join(dirpath, filename)
+            yield fullpath[len(path) + 1:], fullpath
+
+
 def path2dict(path):
     """Reads a path into a dictionary"""
     output = {}
@@ -85,51 +145,172 @@ def stdout_same_line(line):
     sys.stdout.flush()
 
 
+@functools.lru_cache(maxsize=None)
+def decode_key(key):
+    """Key material from its hex string, decoded once per key"""
+    return codecs.decode(key, 'hex')
+
+
+def ctr_cipher(key, ivector):
+    """AES CTR cipher, the whole 128 bits initialization vector is the
+    initial counter"""
+    if not isinstance(ivector, int):
+        ivector = int(codecs.encode(bytes(ivector), 'hex'), 16)
+    ctr = Counter.new(128, initial_value=ivector)
+    return AES.new(decode_key(key), mode=AES.MODE_CTR, counter=ctr)
+
+
+_HOOKS = []
+
+
+def add_hook(hook):
+    """Register hook(stage, seconds, nbytes, filepath), called after every
+    instrumented stage: toc, read, inflate, sng and write"""
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    """Unregister a hook"""
+    _HOOKS.remove(hook)
+
+
+@contextlib.contextmanager
+def instrument(stage, nbytes=0, filepath=None):
+    """Time a stage and report it to the hooks, if any"""
+    if not _HOOKS:
+        yield
+        return
+
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    for hook in list(_HOOKS):
+        hook(stage, elapsed, nbytes, filepath)
+
+
+class StageStats:
+    """Hook aggregating time and bytes per stage, and per stage of every
+    entry"""
+
+    def __init__(self):
+        self.stages = {}
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, seconds, nbytes, filepath):
+        with self.lock:
+            totals = self.stages.setdefault(
+                stage, {'seconds': 0.0, 'bytes': 0, 'count': 0})
+            totals['seconds'] += seconds
+            totals['bytes'] += nbytes
+            totals['count'] += 1
+
+            if filepath is not None:
+                entry = self.entries.setdefault(filepath, {})
+                totals = entry.setdefault(stage, {'seconds': 0.0, 'bytes': 0})
+                totals['seconds'] += seconds
+                totals['bytes'] += nbytes
+
+    def as_dict(self):
+        """Statistics, ready to be dumped as JSON"""
+        with self.lock:
+            stages = {}
+            for stage, totals in self.stages.items():
+                stages[stage] = dict(totals)
+                stages[stage]['mb_per_s'] = \
+                    totals['bytes'] / max(totals['seconds'], 1e-9) / 1e6
+            return {
+                'stages': stages,
+                'entries': {filepath: {stage: dict(totals)
+                                       for stage, totals in entry.items()}
+                            for filepath, entry in self.entries.items()}
+            }
+
+
 def aes_ctr(data, key, ivector, encrypt=True):
     """AES CTR Mode"""
-    output = bytes()
-    #First param: Number of bits of the cipher. 64 is not meaningful.
-    ctr = Counter.new(64, initial_value = ivector)
-    cipher = AES.new(codecs.decode(key,'hex'), mode=AES.MODE_CTR, counter=ctr)
+    cipher = ctr_cipher(key, ivector)
 
     if encrypt:
-        output += cipher.encrypt(pad(data))
-    else:
-        output += cipher.decrypt(pad(data))
+        return cipher.encrypt(pad(data))
+    return cipher.decrypt(pad(data))
 
-    return output
 
+class SngError(ValueError):
+    """Raised when an SNG payload cannot be decoded"""
 
-def decrypt_sng(data, key):
-    """Decrypt SNG. Data consist of a 8 bytes header, 16 bytes initialization
-    vector and payload and the DSA signature. Payload is first decrypted using
-    AES CTR and then zlib decompressed. Size is checked."""
-    #Changed conversion from bytes to int for initial value.
-    decrypted = aes_ctr(data[24:], key, int(codecs.encode(data[8:24],'hex'),16), encrypt=False)
-    length = struct.unpack('<L', decrypted[:4])[0]  # file size
-    payload = ''
-    try:
-        payload = zlib.decompress(decrypted[4:])
-        assert len(payload) == length
-    except Exception as e:
-        #print('An error occurred while processing sng!')
-        #print(e)
-        payload = decrypted
 
-    return payload
+SNG_HEADER = 24  # magic, flags and initialization vector
 
 
-def encrypt_sng(data, key):
-    """Encrypt SNG"""
-    output = struct.pack('<LL', 0x4a, 3)  # the header
+def decrypt_sng(data, key):
+    """Decrypt SNG. Data consist of a 8 bytes header, 16 bytes initialization
+    vector and payload and the DSA signature. Payload is decrypted using
+    AES CTR chunk by chunk, each chunk being fed to zlib as it comes. Size is
+    checked."""
+    view = memoryview(data)
+    if len(view) < SNG_HEADER + 4:
+        raise SngError('SNG is truncated')
+
+    cipher = ctr_cipher(key, view[8:SNG_HEADER])
+    inflater = zlib.decompressobj()
+
+    chunk = cipher.decrypt(view[SNG_HEADER:SNG_HEADER + BLOCK_SIZE])
+    length = struct.unpack('<L', chunk[:4])[0]  # file size
+    chunk = chunk[4:]
+
+    output = []
+    position = 0
+    offset = SNG_HEADER + BLOCK_SIZE
+    while True:
+        try:
+            payload = inflater.decompress(chunk, length - position + 1)
+        except zlib.error as e:
+            raise SngError('SNG payload does not inflate: ' + str(e))
+        if position + len(payload) > length:
+            raise SngError('SNG payload is larger than its header says')
+        output.append(payload)
+        position += len(payload)
+
+        if inflater.eof:
+            break
+        if inflater.unconsumed_tail:
+            chunk = inflater.unconsumed_tail
+            continue
+        if offset >= len(view):
+            raise SngError('SNG payload is truncated')
+        chunk = cipher.decrypt(view[offset:offset + BLOCK_SIZE])
+        offset += BLOCK_SIZE
+
+    if position != length:
+        raise SngError('SNG payload is {0} bytes, header says {1}'.format(
+            position, length))
+
+    return b''.join(output)
+
+
+def encrypt_sng(data, key, level=zlib.Z_BEST_COMPRESSION):
+    """Encrypt SNG. Payload is zlib compressed and encrypted chunk by
+    chunk."""
+    ivector = bytes(16)
+    cipher = ctr_cipher(key, ivector)
+    deflater = zlib.compressobj(level)
 
-    payload = struct.pack('<L', len(data))
-    payload += zlib.compress(data, zlib.Z_BEST_COMPRESSION)
+    output = [struct.pack('<LL', 0x4a, 3), ivector]  # the header
+    output.append(cipher.encrypt(struct.pack('<L', len(data))))
+    size = 4
 
-    ivector = bytes(16)
-    output += ivector
-    output += aes_ctr(payload, key, ivector)
-    return output + bytes(56)
+    view = memoryview(data)
+    for i in range(0, len(view), BLOCK_SIZE):
+        chunk = deflater.compress(view[i:i + BLOCK_SIZE])
+        output.append(cipher.encrypt(chunk))
+        size += len(chunk)
+    chunk = deflater.flush()
+    size += len(chunk)
+    output.append(cipher.encrypt(chunk + bytes(-size % 16)))  # zeros padding
+
+    output.append(bytes(56))  # DSA signature
+    return b''.join(output)
 
 
 def decrypt_config(data):
@@ -151,31 +332,149 @@ def encrypt_config(data):
     return t
 
 
-def read_entry(filestream, entry):
-    """Extract zlib for one entry"""
-    data = bytes()
+def name_hash(name):
+    """MD5 digest of an entry path as stored in the TOC"""
+    if name == '':
+        return bytes(16)
+    return hashlib.md5(name.encode('utf-8')).digest()
 
-    length = entry['length']
-    zlength = entry['zlength']
-    filestream.seek(entry['offset'])
 
-    i = 0
-    while len(data) < length:
-        if zlength[i] == 0:
-            data += filestream.read(BLOCK_SIZE)
-        else:
-            chunk = filestream.read(zlength[i])
-            try:
-                data += zlib.decompress(chunk)
-            except zlib.error:
-                data += chunk
-        i += 1
+def block_count(length):
+    """Number of data blocks used by an entry of a given length"""
+    return (length + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+
+def stored_size(entry):
+    """Size of the data of an entry as stored in the archive"""
+    return sum(z or BLOCK_SIZE for z in entry['zlength'])
+
+
+def block_positions(entry):
+    """Offset in the archive of every stored block of an entry"""
+    positions = []
+    position = entry['offset']
+    for zlength in entry['zlength']:
+        positions.append(position)
+        position += zlength or BLOCK_SIZE
+    return positions
+
+
+def block_range(entry, start, length):
+    """Blocks overlapping bytes [start, start + length) of an entry, as a
+    range of indexes, and the end of the byte range clipped to the entry"""
+    if start < 0 or length < 0:
+        raise ValueError('Negative range {0}+{1}'.format(start, length))
+    end = min(start + length, entry['length'])
+    if start >= end:
+        return range(0), start
+    return range(start // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1), end
+
+
+def block_length(entry, idx):
+    """Length of block idx of an entry once inflated"""
+    return min(BLOCK_SIZE, entry['length'] - idx * BLOCK_SIZE)
+
+
+def raw_block(entry, idx):
+    """Whether block idx of an entry is stored uncompressed. Raw blocks
+    store their whole content, compressed ones are always smaller."""
+    zlength = entry['zlength'][idx]
+    return zlength == 0 or zlength == block_length(entry, idx)
+
+
+def inflate_block(chunk, entry, idx):
+    """Inflate stored block idx of an entry. Raw blocks are returned as is.
+    Raises ValueError if the block is corrupt or does not inflate to its
+    length."""
+    if raw_block(entry, idx):
+        data = bytes(chunk)
+    else:
+        try:
+            data = zlib.decompress(chunk)
+        except zlib.error as e:
+            raise ValueError('Block {0} is corrupt: {1}'.format(idx, e))
+
+    expected = block_length(entry, idx)
+    if len(data) != expected:
+        raise ValueError('Block {0} inflated to {1} bytes, expected '
+                         '{2}'.format(idx, len(data), expected))
+    return data
+
+
+_THREAD_POOLS = {}
+
+# Forked children inherit the pools but none of their threads
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_THREAD_POOLS.clear)
+
+
+def thread_pool(jobs):
+    """Shared thread pool with a given number of workers"""
+    if jobs not in _THREAD_POOLS:
+        _THREAD_POOLS[jobs] = ThreadPoolExecutor(jobs)
+    return _THREAD_POOLS[jobs]
+
+
+def bounded_map(function, iterable, jobs=1):
+    """Ordered map over the thread pool which only consumes the iterable as
+    results are taken, keeping at most a few items per job in flight"""
+    if jobs <= 1:
+        for item in iterable:
+            yield function(item)
+        return
+
+    pool = thread_pool(jobs)
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.submit(function, item))
+        if len(pending) >= 4 * jobs:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def inflate_blocks(buf, entry, jobs=1):
+    """Inflate the stored blocks of an entry into a preallocated buffer.
+    Block i lands at i * BLOCK_SIZE, so blocks are independent and, with more
+    than one job, are inflated by a thread pool (zlib releases the GIL).
+    The buffer is returned as is, a bytearray, to avoid copying it."""
+    output = bytearray(entry['length'])
+    view = memoryview(output)
+
+    blocks = []
+    position = 0
+    for idx, z in enumerate(entry['zlength']):
+        size = z or BLOCK_SIZE
+        blocks.append((idx, position, size))
+        position += size
+
+    def inflate(block):
+        idx, position, size = block
+        data = inflate_block(buf[position:position + size], entry, idx)
+        start = idx * BLOCK_SIZE
+        view[start:start + len(data)] = data
+
+    if jobs > 1 and len(blocks) > 1:
+        list(thread_pool(jobs).map(inflate, blocks))
+    else:
+        for block in blocks:
+            inflate(block)
+
+    return output
+
+
+def unpack_entry(buf, entry, jobs=1):
+    """Extract zlib for one entry from a buffer holding its stored data.
+    Returns a bytearray, or bytes for SNGs."""
+    filepath = entry['filepath']
+    with instrument('inflate', entry['length'], filepath):
+        data = inflate_blocks(buf, entry, jobs)
 
     # Post process for sng
-    if entry['filepath'].find('songs/bin/macos/') > -1:
-        data = decrypt_sng(data, MAC_KEY)
-    elif entry['filepath'].find('songs/bin/generic/') > -1:
-        data = decrypt_sng(data, PC_KEY)
+    key = sng_key(filepath)
+    if key is not None:
+        with instrument('sng', len(data), filepath):
+            data = decrypt_sng(data, key)
 
     # Requires bypass for ini
     # if entry['filepath'] == 'pkgconfig.ini':
@@ -184,42 +483,295 @@ def read_entry(filestream, entry):
     return data
 
 
-def create_entry(name, data):
-    """Chunk a file"""
+_SEEK_LOCK = threading.Lock()
+
+
+def read_at(filestream, offset, size):
+    """Read size bytes at offset without relying on the position of the
+    stream, so that threads can share one open archive. Files are read with
+    os.pread and memory maps sliced, other streams seek under a lock."""
+    if isinstance(filestream, mmap.mmap):
+        return filestream[offset:offset + size]
+
+    fileno = None
+    if hasattr(os, 'pread'):
+        try:
+            fileno = filestream.fileno()
+        except (AttributeError, OSError):
+            pass
+
+    if fileno is None:
+        with _SEEK_LOCK:
+            filestream.seek(offset)
+            return filestream.read(size)
+
+    chunks = []
+    while size > 0:
+        chunk = os.pread(fileno, size, offset)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+# Kernel copies fall back to the next method on these
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EBADF,
+                     errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK}
+
+
+def write_all(fd, data):
+    """Write all of data to a file descriptor"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def copy_range(source, offset, destination, size):
+    """Copy size bytes at offset of file descriptor source to the current
+    position of file descriptor destination. The copy is done in the kernel
+    with os.copy_file_range or os.sendfile where available, and through a
+    buffer otherwise."""
+    methods = [
+        lambda: os.copy_file_range(source, destination, size, offset),
+        lambda: os.sendfile(destination, source, offset, size)
+    ]
+    if not hasattr(os, 'copy_file_range'):
+        methods.pop(0)
+    if not hasattr(os, 'sendfile'):
+        methods.pop()
+
+    for method in methods:
+        try:
+            while size > 0:
+                copied = method()
+                if copied == 0:
+                    raise ValueError('Unexpected end of file at {0}'.format(
+                        offset))
+                offset += copied
+                size -= copied
+            return
+        except OSError as e:
+            if e.errno not in _COPY_UNSUPPORTED:
+                raise
+
+    while size > 0:
+        if hasattr(os, 'pread'):
+            chunk = os.pread(source, min(size, 16 * BLOCK_SIZE), offset)
+        else:
+            os.lseek(source, offset, os.SEEK_SET)
+            chunk = os.read(source, min(size, 16 * BLOCK_SIZE))
+        if not chunk:
+            raise ValueError('Unexpected end of file at {0}'.format(offset))
+        write_all(destination, chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+
+
+def read_entry(filestream, entry, jobs=1):
+    """Extract zlib for one entry. Safe to call from many threads on the same
+    stream. Returns a bytearray, or bytes for SNGs, as unpack_entry."""
+    size = stored_size(entry)
+    with instrument('read', size, entry.get('filepath')):
+        buf = read_at(filestream, entry['offset'], size)
+    return unpack_entry(buf, entry, jobs)
+
+
+def entry_range(entry, start, length, read_block, decode):
+    """Bytes [start, start + length) of an entry, clipped to its length.
+    Only the blocks overlapping the range are taken from read_block(idx),
+    which returns an inflated block. SNGs are encrypted as a whole, their
+    decoded content is taken from decode()."""
+    indexes, end = block_range(entry, start, length)
+    if is_encrypted(entry['filepath']):
+        return decode()[start:start + length]
+
+    output = []
+    for idx in indexes:
+        data = read_block(idx)
+        base = idx * BLOCK_SIZE
+        output.append(data[max(start - base, 0):end - base])
+    return b''.join(output)
+
+
+def read_entry_range(filestream, entry, start, length):
+    """Bytes [start, start + length) of an entry, as entry_range, blocks
+    being read at their position in the stream"""
+    positions = block_positions(entry)
+
+    def read_block(idx):
+        zlength = entry['zlength'][idx]
+        size = zlength or BLOCK_SIZE
+        with instrument('read', size, entry['filepath']):
+            chunk = read_at(filestream, positions[idx], size)
+        with instrument('inflate', block_length(entry, idx),
+                        entry['filepath']):
+            return inflate_block(chunk, entry, idx)
+
+    return entry_range(entry, start, length, read_block,
+                       lambda: read_entry(filestream, entry))
+
+
+def sng_key(name):
+    """Platform key of an SNG entry, None for other entries"""
+    if name.find('songs/bin/macos/') > -1:
+        return MAC_KEY
+    if name.find('songs/bin/generic/') > -1:
+        return PC_KEY
+    return None
+
+
+def is_encrypted(name):
+    """Whether an entry is transformed by prepare_entry"""
+    return sng_key(name) is not None
+
+
+def prepare_entry(name, data, level=zlib.Z_BEST_COMPRESSION):
+    """Pre process an entry before chunking"""
 
     # Pre process for sng
-    if name.find('songs/bin/macos/') > -1:
-        data = encrypt_sng(data, MAC_KEY)
-    elif name.find('songs/bin/generic/') > -1:
-        data = encrypt_sng(data, PC_KEY)
+    key = sng_key(name)
+    if key is not None:
+        data = encrypt_sng(data, key, level)
 
     # Requires bypass for ini
     # if name == 'pkgconfig.ini':
     #     data = encrypt_config(data)
 
-    zlength = []
-    output = ''
+    return data
 
-    i = 0
-    while i < len(data):
-        raw = data[i:i + BLOCK_SIZE]
-        i += BLOCK_SIZE
-
-        compressed = zlib.compress(raw, zlib.Z_BEST_COMPRESSION)
-        if len(compressed) < len(raw):
-            output += compressed
-            zlength.append(len(compressed))
+
+def deflate_block(raw, level=zlib.Z_BEST_COMPRESSION):
+    """Compress one block. Returns the stored data and its zlength, blocks
+    that do not shrink, or all blocks with the store profile, are stored
+    raw."""
+    if level == zlib.Z_NO_COMPRESSION:
+        return bytes(raw), len(raw) % BLOCK_SIZE
+
+    compressed = zlib.compress(raw, level)
+    if len(compressed) < len(raw):
+        return compressed, len(compressed)
+    return bytes(raw), len(raw) % BLOCK_SIZE
+
+
+class AdaptiveDeflate:
+    """Block compressor of adaptive packing, called as deflate_block. Blocks
+    of files with one of the STORED_EXTENSIONS, and blocks of which a sample
+    does not shrink at the fastest level, are stored raw without trying the
+    requested level. What was skipped is counted, the CPU time saved being
+    estimated from the time the level takes on one incompressible block."""
+
+    SAMPLE = 4096
+
+    def __init__(self, level=zlib.Z_BEST_COMPRESSION):
+        self.level = level
+        self.lock = threading.Lock()
+        self.blocks = 0
+        self.skipped = 0
+        self.skipped_bytes = 0
+        self.trial_seconds = 0.0
+
+        noise = os.urandom(BLOCK_SIZE)
+        self.block_seconds = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            zlib.compress(noise, level)
+            self.block_seconds = min(self.block_seconds,
+                                     time.perf_counter() - start)
+
+    def incompressible(self, raw):
+        """Whether a sample of the start, middle and end of a block does not
+        shrink by at least 1% at the fastest level"""
+        if len(raw) > 3 * self.SAMPLE:
+            middle = (len(raw) - self.SAMPLE) // 2
+            sample = b''.join(bytes(raw[start:start + self.SAMPLE])
+                              for start in (0, middle,
+                                            len(raw) - self.SAMPLE))
         else:
-            output += raw
-            zlength.append(len(raw) % BLOCK_SIZE)
+            sample = bytes(raw)
+        return len(zlib.compress(sample, zlib.Z_BEST_SPEED)) >= \
+            0.99 * len(sample)
+
+    def __call__(self, raw, store=False):
+        trial = 0.0
+        if self.level == zlib.Z_NO_COMPRESSION:
+            # Nothing is compressed, nothing is skipped
+            store = False
+        elif not store:
+            start = time.perf_counter()
+            store = self.incompressible(raw)
+            trial = time.perf_counter() - start
+
+        with self.lock:
+            self.blocks += 1
+            self.trial_seconds += trial
+            if store:
+                self.skipped += 1
+                self.skipped_bytes += len(raw)
+
+        if store:
+            return bytes(raw), len(raw) % BLOCK_SIZE
+        return deflate_block(raw, self.level)
+
+    def stats(self):
+        """Blocks seen, skipped blocks and bytes, time spent on trials and
+        the estimated compression time skipped, in seconds"""
+        with self.lock:
+            return {
+                'blocks': self.blocks,
+                'skipped': self.skipped,
+                'skipped_bytes': self.skipped_bytes,
+                'trial_seconds': self.trial_seconds,
+                'skipped_seconds':
+                    self.skipped_bytes / BLOCK_SIZE * self.block_seconds
+            }
+
+
+def stored_extension(name):
+    """Whether adaptive packing stores a file raw because of its extension"""
+    return name.lower().endswith(STORED_EXTENSIONS)
+
+
+def create_entries(items, jobs=1, level=zlib.Z_BEST_COMPRESSION,
+                   adaptive=None):
+    """Chunk a sequence of (name, data) pairs, yielding entries in order.
+    The blocks of all entries are compressed as one batch, so with more than
+    one job small entries keep the thread pool busy as well as large ones.
+    Blocks are compressed by an AdaptiveDeflate, if given."""
+    prepared = [(name, prepare_entry(name, data, level))
+                for name, data in items]
+
+    blocks = []
+    for name, data in prepared:
+        view = memoryview(data)
+        store = adaptive is not None and stored_extension(name)
+        blocks += [(view[i:i + BLOCK_SIZE], store)
+                   for i in range(0, len(data), BLOCK_SIZE)]
+
+    if adaptive is None:
+        deflate = lambda block: deflate_block(block[0], level)
+    else:
+        deflate = lambda block: adaptive(*block)
+    if jobs > 1 and len(blocks) > 1:
+        deflated = thread_pool(jobs).map(deflate, blocks)
+    else:
+        deflated = map(deflate, blocks)
+
+    for name, data in prepared:
+        chunks = [next(deflated) for _ in range(block_count(len(data)))]
+        yield {
+            'filepath': name,
+            'zlength': [zlength for _, zlength in chunks],
+            'length': len(data),
+            'data': b''.join(chunk for chunk, _ in chunks),
+            'md5': name_hash(name)
+        }
 
-    return {
-        'filepath': name,
-        'zlength': zlength,
-        'length': len(data),
-        'data': output,
-        'md5': md5.new(name).digest() if name != '' else bytes(16)
-    }
+
+def create_entry(name, data, jobs=1, level=zlib.Z_BEST_COMPRESSION):
+    """Chunk a file"""
+    return next(create_entries([(name, data)], jobs, level))
 
 
 def cipher_toc():
@@ -228,43 +780,71 @@ def cipher_toc():
                    IV=codecs.decode(ARC_IV,'hex'), segment_size=128)
 
 
-def read_toc(filestream):
-    """Read entry list and Z-fragments.
-    Returns a list of entries to be used with read_entry."""
+# md5, zindex, then length and offset as 40 bits big endian integers
+TOC_ENTRY = struct.Struct('>16sLBLBL')
 
-    entries = []
-    zlength = []
 
-    filestream.seek(0)
-    header = struct.unpack('>4sL4sLLLLL', filestream.read(32))
+def decode_toc(toc, n_entries, n_blocks):
+    """Decode the decrypted entry and block tables in bulk"""
+    view = memoryview(toc)
+    table_size = ENTRY_SIZE * n_entries
+
+    entries = [{
+        'md5': md5,
+        'zindex': zindex,
+        'length': length_hi << 32 | length_lo,
+        'offset': offset_hi << 32 | offset_lo
+    } for md5, zindex, length_hi, length_lo, offset_hi, offset_lo
+        in TOC_ENTRY.iter_unpack(view[:table_size])]
+
+    zlength = array.array('H')
+    zlength.frombytes(view[table_size:table_size + 2 * n_blocks])
+    if sys.byteorder == 'little':
+        zlength.byteswap()
+    zlength = zlength.tolist()
+
+    for entry in entries:
+        zindex = entry['zindex']
+        entry['zlength'] = zlength[zindex:zindex + block_count(entry['length'])]
+
+    return entries
+
+
+def encode_tables(entries, zlength, size):
+    """Encode the entry and block tables in bulk, offsets are made absolute
+    using the size of the TOC"""
+    table = b''.join(TOC_ENTRY.pack(
+        entry['md5'], entry['zindex'],
+        entry['length'] >> 32, entry['length'] & 0xFFFFFFFF,
+        (entry['offset'] + size) >> 32, (entry['offset'] + size) & 0xFFFFFFFF)
+        for entry in entries)
+
+    blocks = array.array('H', zlength)
+    if sys.byteorder == 'little':
+        blocks.byteswap()
+    return table + blocks.tobytes()
+
+
+def read_header(filestream):
+    """Read and decrypt the header and TOC.
+    Returns the header fields and the decoded entries, the file listing
+    being the first one."""
+    header = struct.unpack('>4sL4sLLLLL', read_at(filestream, 0, 32))
 
     toc_size = header[3] - 32
     n_entries = header[5]
-    toc = cipher_toc().decrypt(pad(filestream.read(toc_size)))
-    toc_position = 0
-
-    idx = 0
-    while idx < n_entries:
-        data = toc[toc_position:toc_position + ENTRY_SIZE]
-
-        entries.append({
-            'md5': data[:16],
-            'zindex': struct.unpack('>L', data[16:20])[0],
-            'length': struct.unpack('>Q', b'\x00'*3 + data[20:25])[0],
-            'offset': struct.unpack('>Q', b'\x00'*3 + data[25:])[0]
-        })
-        toc_position += ENTRY_SIZE
-        idx += 1
-
-    idx = 0
-    while idx < (toc_size - ENTRY_SIZE * n_entries) / 2:
-        data = toc[toc_position:toc_position + 2]
-        zlength.append(struct.unpack('>H', data)[0])
-        toc_position += 2
-        idx += 1
+    n_blocks = (toc_size - ENTRY_SIZE * n_entries) // 2
+    with instrument('toc', toc_size):
+        toc = cipher_toc().decrypt(pad(read_at(filestream, 32, toc_size)))
+        entries = decode_toc(toc, n_entries, n_blocks)
 
-    for entry in entries:
-        entry['zlength'] = zlength[entry['zindex']:]
+    return header, entries
+
+
+def read_toc(filestream):
+    """Read entry list and Z-fragments.
+    Returns a list of entries to be used with read_entry."""
+    _, entries = read_header(filestream)
 
     # Process the first entry as it contains the file listing
     entries[0]['filepath'] = ''
@@ -275,12 +855,41 @@ def read_toc(filestream):
     return entries[1:]
 
 
+def toc_size(n_entries, n_blocks):
+    """Size of the header and TOC"""
+    return 32 + ENTRY_SIZE * n_entries + 2 * n_blocks
+
+
+def encode_toc(entries):
+    """Build an encrypted TOC for entries whose offset and zindex are set.
+    Offsets are relative to the end of the TOC."""
+
+    # Entries with the same content may share their blocks
+    n_blocks = max([entry['zindex'] + len(entry['zlength'])
+                    for entry in entries] + [0])
+    zlength = [0] * n_blocks
+    for entry in entries:
+        zindex = entry['zindex']
+        zlength[zindex:zindex + len(entry['zlength'])] = entry['zlength']
+
+    size = toc_size(len(entries), len(zlength))
+
+    header = struct.pack('>4sL4sLLLLL', MAGIC, VERSION, COMPRESSION,
+                         size, ENTRY_SIZE, len(entries),
+                         BLOCK_SIZE, ARCHIVE_FLAGS)
+
+    toc = encode_tables(entries, zlength, size)
+
+    # the [:toc_size] seems a little odd, but padding is not applied
+    # in official PSARC either
+    return (header + cipher_toc().encrypt(pad(toc)))[:size]
+
+
 def create_toc(entries):
     """Build an encrypted TOC for a given list of entries."""
 
     offset = 0
     zindex = 0
-    zlength = []
     for entry in entries:
         entry['offset'] = offset
         offset += len(entry['data'])
@@ -288,58 +897,374 @@ def create_toc(entries):
         entry['zindex'] = zindex
         zindex += len(entry['zlength'])
 
-        zlength += entry['zlength']
+    return encode_toc(entries)
 
-    toc_size = 32 + ENTRY_SIZE * len(entries) + 2 * len(zlength)
 
-    header = struct.pack('>4sL4sLLLLL', MAGIC, VERSION, COMPRESSION,
-                         toc_size, ENTRY_SIZE, len(entries),
-                         BLOCK_SIZE, ARCHIVE_FLAGS)
-
-    toc = ''
-    for entry in entries:
-        toc += entry['md5']
-        toc += struct.pack('>L', entry['zindex'])
-        toc += struct.pack('>Q', entry['length'])[-5:]
-        toc += struct.pack('>Q', entry['offset'] + toc_size)[-5:]
-
-    for i in zlength:
-        toc += struct.pack('>H', i)
-
-    # the [:toc_size] seems a little odd, but padding is not applied
-    # in official PSARC either
-    return (header + cipher_toc().encrypt(pad(toc)))[:toc_size]
-
-
-def extract_psarc(filename):
-    """Extract a PSARC to disk"""
+def glob_regex(pattern):
+    """Compile a path glob. * and ? do not match /, ** matches anything and
+    **/ zero or more folders."""
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r'\Z')
+
+
+def filter_entries(entries, include=None, exclude=None):
+    """Entries whose path matches one of the include globs, if any, and none
+    of the exclude globs. Only the TOC listing is needed."""
+    include = [glob_regex(p) for p in include or []]
+    exclude = [glob_regex(p) for p in exclude or []]
+
+    def keep(filepath):
+        if include and not any(r.match(filepath) for r in include):
+            return False
+        return not any(r.match(filepath) for r in exclude)
+
+    return [entry for entry in entries if keep(entry['filepath'])]
+
+
+class PsarcArchive:
+    """Random access to the entries of a PSARC. The file is memory mapped
+    and the TOC is decoded once, entries can then be looked up by path or by
+    MD5 name hash. Reads are slices of the map, one archive can be shared by
+    many threads."""
+
+    def __init__(self, filename, entries=None):
+        self.filename = filename
+        with open(filename, 'rb') as fstream:
+            self.mmap = mmap.mmap(fstream.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # A previously decoded TOC, as cached by psarcindex, can be given
+        try:
+            self.entries = read_toc(self.mmap) if entries is None else entries
+        except Exception:
+            self.mmap.close()
+            raise
+        self.paths = {entry['filepath']: entry for entry in self.entries}
+        self.hashes = {entry['md5']: entry for entry in self.entries}
+        self.positions = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, filepath):
+        return filepath in self.paths
+
+    def __getitem__(self, filepath):
+        return self.paths[filepath]
+
+    def close(self):
+        """Release the memory map"""
+        self.mmap.close()
+
+    def lookup(self, digest):
+        """Entry for a given MD5 name hash, or None"""
+        return self.hashes.get(digest)
+
+    def entry(self, entry):
+        """Accept either an entry or its path"""
+        if isinstance(entry, dict):
+            return entry
+        return self.paths[entry]
+
+    def stored(self, entry):
+        """Stored (compressed) data of an entry as a memoryview"""
+        entry = self.entry(entry)
+        offset = entry['offset']
+        return memoryview(self.mmap)[offset:offset + stored_size(entry)]
+
+    def read_block(self, entry, idx):
+        """Inflated block idx of an entry. SNGs are encrypted as a whole, the
+        block is returned as stored in the archive, not decrypted."""
+        entry = self.entry(entry)
+        positions = self.positions.get(entry['filepath'])
+        if positions is None:
+            positions = block_positions(entry)
+            self.positions[entry['filepath']] = positions
+
+        zlength = entry['zlength'][idx]
+        position = positions[idx]
+        return inflate_block(
+            self.mmap[position:position + (zlength or BLOCK_SIZE)], entry, idx)
+
+    def read_range(self, entry, start, length):
+        """Bytes [start, start + length) of an entry, clipped to its length,
+        inflating only the blocks overlapping the range. SNGs are decoded
+        entirely."""
+        entry = self.entry(entry)
+        return entry_range(entry, start, length,
+                           functools.partial(self.read_block, entry),
+                           functools.partial(self.read, entry))
+
+    def read(self, entry, jobs=1):
+        """Decompressed (and decrypted) content of an entry, a bytearray or
+        bytes for SNGs as from unpack_entry"""
+        return read_entry(self.mmap, self.entry(entry), jobs)
+
+
+def preallocate_file(fname, length):
+    """Create a file of a given length, allocating its blocks up front where
+    the platform and file system allow it. Returns a writable memory map of
+    the file, or None for an empty one."""
+    fd = os.open(fname, os.O_RDWR | os.O_CREAT | os.O_TRUNC |
+                 getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        if length == 0:
+            return None
+        try:
+            os.posix_fallocate(fd, 0, length)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, length)
+        return mmap.mmap(fd, length)
+    finally:
+        os.close(fd)
+
+
+def extract_preallocated(psarc, entries, basepath, jobs=1, log=None):
+    """Extract entries of an open PSARC into files preallocated at their
+    length and memory mapped. Blocks of all entries are inflated by the
+    thread pool straight to i * BLOCK_SIZE of their file, so a single large
+    archive is extracted by every job and entries are never held whole in
+    memory. SNGs are decrypted as a whole. Returns the number of bytes
+    written."""
+    # Directories are created at once, before any block is inflated
+    for path in sorted({os.path.dirname(os.path.join(basepath,
+                                                     entry['filepath']))
+                        for entry in entries}):
+        os.makedirs(path, exist_ok=True)
+
+    def write_sng(entry, fname):
+        data = psarc.read(entry)
+        with instrument('write', len(data), entry['filepath']):
+            with open(fname, 'wb') as fstream:
+                fstream.write(data)
+        return len(data)
+
+    def inflate_into(output, entry, idx, position, zlength):
+        size = zlength or BLOCK_SIZE
+        with instrument('read', size, entry['filepath']):
+            chunk = psarc.mmap[position:position + size]
+        start = idx * BLOCK_SIZE
+        with instrument('inflate', block_length(entry, idx),
+                        entry['filepath']):
+            data = inflate_block(chunk, entry, idx)
+        with instrument('write', len(data), entry['filepath']):
+            output[start:start + len(data)] = data
+        return len(data)
+
+    def close(output, entry):
+        # Bytes were counted as they were stored in the map
+        with instrument('write', 0, entry['filepath']):
+            output.close()
+
+    def tasks():
+        """Work items and, for the last block of an entry, the call closing
+        its output"""
+        logmsg = 'Extracting ' + basepath + ' {0}/' + str(len(entries))
+        for idx, entry in enumerate(entries):
+            if log:
+                log(logmsg.format(idx + 1))
+            fname = os.path.join(basepath, entry['filepath'])
+            if is_encrypted(entry['filepath']):
+                yield functools.partial(write_sng, entry, fname), None
+                continue
+
+            if len(entry['zlength']) != block_count(entry['length']):
+                raise ValueError(entry['filepath'] + ': block table is '
+                                 'truncated')
+            output = preallocate_file(fname, entry['length'])
+            if output is None:
+                continue
+
+            last = len(entry['zlength']) - 1
+            for i, (position, zlength) in enumerate(
+                    zip(block_positions(entry), entry['zlength'])):
+                yield (functools.partial(inflate_into, output, entry, i,
+                                         position, zlength),
+                       functools.partial(close, output, entry)
+                       if i == last else None)
+
+    written = 0
+    # Results come in order, once the last block of an entry is through
+    # all of its blocks are
+    for size, finish in bounded_map(lambda task: (task[0](), task[1]),
+                                    tasks(), jobs):
+        written += size
+        if finish:
+            finish()
+    return written
+
+
+def extract_entry(psarc, source, entry, fname, jobs=1):
+    """Write an entry of an open PSARC to a file, block by block. Runs of raw
+    blocks are copied from the file descriptor source by copy_range, never
+    going through Python, other blocks are inflated. SNGs are not handled.
+    Returns the number of bytes written."""
+    filepath = entry['filepath']
+    if len(entry['zlength']) != block_count(entry['length']):
+        raise ValueError(filepath + ': block table is truncated')
+
+    def inflate(block):
+        idx, position, zlength = block
+        with instrument('read', zlength, filepath):
+            chunk = psarc.mmap[position:position + zlength]
+        with instrument('inflate', block_length(entry, idx), filepath):
+            return inflate_block(chunk, entry, idx)
+
+    blocks = zip(itertools.count(), block_positions(entry), entry['zlength'])
+    written = 0
+    with open(fname, 'wb', buffering=0) as fstream:
+        fd = fstream.fileno()
+        for raw, run in itertools.groupby(
+                blocks, key=lambda block: raw_block(entry, block[0])):
+            if raw:
+                run = list(run)
+                size = sum(zlength or BLOCK_SIZE for _, _, zlength in run)
+                with instrument('write', size, filepath):
+                    copy_range(source, run[0][1], fd, size)
+                written += size
+                continue
+
+            for data in bounded_map(inflate, run, jobs):
+                with instrument('write', len(data), filepath):
+                    write_all(fd, data)
+                written += len(data)
+
+    return written
+
+
+def extract_psarc(filename, jobs=1, log=stdout_same_line,
+                  include=None, exclude=None, preallocate=False):
+    """Extract a PSARC to disk, optionally only the entries selected by
+    include/exclude globs. With preallocate, entries are extracted by
+    extract_preallocated, otherwise one after the other by extract_entry.
+    Returns the number of entries and of bytes written."""
     basepath = os.path.basename(filename)[:-6]
+    written = 0
+
+    with PsarcArchive(filename) as psarc, open(filename, 'rb') as source:
+        entries = filter_entries(psarc.entries, include, exclude)
+        if preallocate:
+            return len(entries), extract_preallocated(psarc, entries,
+                                                      basepath, jobs, log)
 
-    with open(filename, 'rb') as psarc:
-        entries = read_toc(psarc)
         logmsg = 'Extracting ' + basepath + ' {0}/' + str(len(entries))
-        
+
         for idx, entry in enumerate(entries):
-            stdout_same_line(logmsg.format(idx + 1))
+            if log:
+                log(logmsg.format(idx + 1))
             fname = os.path.join(basepath, entry['filepath'])
-            data = read_entry(psarc, entry)
             path = os.path.dirname(fname)
             if not os.path.exists(path):
                 os.makedirs(path)
-            with open(fname, 'wb') as fstream:
-                fstream.write(data)
 
+            if not is_encrypted(entry['filepath']):
+                written += extract_entry(psarc, source.fileno(), entry, fname,
+                                         jobs)
+                continue
 
-def create_psarc(files, filename):
-    """Writes a dictionary filepath -> data to a PSARC file"""
-    # Order is reversed
-    filenames = reversed(sorted(files.keys()))
-    entries = [create_entry('', '\n'.join(filenames))]
+            data = psarc.read(entry, jobs)
+            with instrument('write', len(data), entry['filepath']):
+                with open(fname, 'wb') as fstream:
+                    fstream.write(data)
+            written += len(data)
+
+        return len(entries), written
 
-    logmsg = 'Creating ' + filename + ' {0}/' + str(len(files))
-    for idx, (name, data) in enumerate(reversed(sorted(files.items()))):
-        stdout_same_line(logmsg.format(idx + 1))
-        entries.append(create_entry(name, data))
+
+def extract_with_stats(filename, jobs=1, include=None, exclude=None,
+                       preallocate=False):
+    """Silent extract_psarc recording per stage statistics. Returns the
+    number of entries, of bytes written and the statistics."""
+    stats = StageStats()
+    add_hook(stats)
+    try:
+        count, written = extract_psarc(filename, jobs, None, include, exclude,
+                                       preallocate)
+    finally:
+        remove_hook(stats)
+    return count, written, stats.as_dict()
+
+
+def extract_batch(filenames, processes=None, jobs=1,
+                  include=None, exclude=None, report=None, preallocate=False):
+    """Extract many PSARCs across a pool of worker processes. Workers are
+    silent, a single aggregated progress line is printed instead. Archives
+    that fail are reported and skipped, their names are returned.
+
+    If a report dictionary is given, it is filled with the statistics of
+    every archive, as from extract_with_stats, and no progress is printed."""
+    failed = []
+    n_entries = 0
+    written = 0
+    start = time.time()
+
+    with ProcessPoolExecutor(processes) as pool:
+        if report is None:
+            futures = {pool.submit(extract_psarc, filename, jobs, None,
+                                   include, exclude, preallocate): filename
+                       for filename in filenames}
+        else:
+            futures = {pool.submit(extract_with_stats, filename, jobs,
+                                   include, exclude, preallocate): filename
+                       for filename in filenames}
+
+        for idx, future in enumerate(as_completed(futures)):
+            try:
+                result = future.result()
+                n_entries += result[0]
+                written += result[1]
+                if report is not None:
+                    report[futures[future]] = result[2]
+            except Exception as e:
+                failed.append(futures[future])
+                sys.stderr.write('Failed {0}: {1}\n'.format(futures[future], e))
+
+            if report is not None:
+                continue
+            elapsed = max(time.time() - start, 1e-6)
+            stdout_same_line(
+                'Extracted {0}/{1} archives, {2} entries, {3:.1f} MB/s, '
+                '{4:.0f} entries/s'.format(
+                    idx + 1, len(futures), n_entries,
+                    written / elapsed / 1e6, n_entries / elapsed))
+
+    if report is None:
+        sys.stdout.write('\n')
+    return failed
+
+
+def write_psarc(entries, filename, jobs=1, level=zlib.Z_BEST_COMPRESSION):
+    """Writes a list of chunked entries to a PSARC file, in reversed path
+    order and preceded by the file listing"""
+    entries = sorted(entries, key=lambda entry: entry['filepath'],
+                     reverse=True)
+    listing = '\n'.join(entry['filepath'] for entry in entries)
+    entries.insert(0, create_entry('', listing.encode('utf-8'), jobs, level))
 
     with open(filename, 'wb') as fstream:
         fstream.write(create_toc(entries))
@@ -347,6 +1272,341 @@ def create_psarc(files, filename):
             fstream.write(entry['data'])
 
 
+def verify_psarc(filename, jobs=1):
+    """Check a PSARC without writing anything: every block is inflated and
+    its size checked against the entry length, name hashes are checked
+    against the listing and SNG payloads against their length prefix.
+    Returns a list of (filepath, problem) and the number of bytes inflated."""
+    problems = []
+
+    with PsarcArchive(filename) as psarc:
+        tasks = []
+        for entry in psarc:
+            filepath = entry['filepath']
+            if entry['md5'] != name_hash(filepath):
+                problems.append((filepath, 'name hash does not match path'))
+            if len(entry['zlength']) != block_count(entry['length']):
+                problems.append((filepath, 'block table is truncated'))
+                continue
+            if entry['offset'] + stored_size(entry) > len(psarc.mmap):
+                problems.append((filepath, 'data runs past end of archive'))
+                continue
+
+            # SNGs are checked whole, as their payload spans blocks
+            if is_encrypted(filepath):
+                tasks.append((entry, None, None, None))
+                continue
+
+            blocks = zip(block_positions(entry), entry['zlength'])
+            for idx, (position, zlength) in enumerate(blocks):
+                tasks.append((entry, idx, position, zlength))
+
+        def check(task):
+            entry, idx, position, zlength = task
+            try:
+                if idx is None:
+                    psarc.read(entry)
+                    return entry['length'], None
+
+                chunk = psarc.mmap[position:position + (zlength or BLOCK_SIZE)]
+                return len(inflate_block(chunk, entry, idx)), None
+            except ValueError as e:
+                return 0, str(e)
+
+        inflated = 0
+        for (entry, _, _, _), (size, problem) in \
+                zip(tasks, bounded_map(check, tasks, jobs)):
+            inflated += size
+            if problem:
+                problems.append((entry['filepath'], problem))
+
+    return problems, inflated
+
+
+def block_digests(psarc, entry):
+    """MD5 of every stored block of an entry, split along its zlength"""
+    digests = []
+    with psarc.stored(entry) as buf:
+        position = 0
+        for zlength in entry['zlength']:
+            size = zlength or BLOCK_SIZE
+            digests.append(hashlib.md5(buf[position:position + size]).digest())
+            position += size
+    return digests
+
+
+def diff_psarc(first, second, jobs=1, notes=None):
+    """Compare two PSARCs. TOCs are compared first, then the stored blocks
+    of entries present in both, and only entries whose blocks differ are
+    inflated. Entries which cannot be decoded count as modified, if a notes
+    dictionary is given it is filled with path -> reason for them. Returns
+    the added, removed and modified paths."""
+    with PsarcArchive(first) as old, PsarcArchive(second) as new:
+        added = sorted(set(new.paths) - set(old.paths))
+        removed = sorted(set(old.paths) - set(new.paths))
+
+        modified = []
+        for filepath in sorted(set(old.paths) & set(new.paths)):
+            a, b = old[filepath], new[filepath]
+            if a['length'] != b['length'] and not is_encrypted(filepath):
+                modified.append(filepath)
+            elif a['zlength'] != b['zlength'] or \
+                    block_digests(old, a) != block_digests(new, b):
+                # Same content may have been compressed differently
+                try:
+                    if old.read(a, jobs) != new.read(b, jobs):
+                        modified.append(filepath)
+                except ValueError as e:
+                    modified.append(filepath)
+                    if notes is not None:
+                        notes[filepath] = str(e)
+
+    return added, removed, modified
+
+
+def toc_stats(entries):
+    """Summary of a decoded TOC: number of entries and blocks, of blocks
+    stored raw, and total lengths. Blocks shared by deduplicated entries
+    are counted once."""
+    stats = {'entries': len(entries), 'blocks': 0, 'raw_blocks': 0,
+             'length': 0, 'stored': 0}
+    regions = set()
+    for entry in entries:
+        stats['length'] += entry['length']
+        if not entry['zlength'] or entry['zindex'] in regions:
+            continue
+        regions.add(entry['zindex'])
+
+        stats['blocks'] += len(entry['zlength'])
+        stats['stored'] += stored_size(entry)
+        for idx in range(len(entry['zlength'])):
+            if raw_block(entry, idx):
+                stats['raw_blocks'] += 1
+    return stats
+
+
+def create_psarc(files, filename, jobs=1, level=zlib.Z_BEST_COMPRESSION,
+                 log=stdout_same_line, adaptive=None):
+    """Writes a dictionary filepath -> data to a PSARC file, blocks being
+    compressed by an AdaptiveDeflate if given"""
+    entries = []
+    logmsg = 'Creating ' + filename + ' {0}/' + str(len(files))
+    items = sorted(files.items())
+    for idx, entry in enumerate(create_entries(items, jobs, level,
+                                               adaptive)):
+        if log:
+            log(logmsg.format(idx + 1))
+        entries.append(entry)
+
+    write_psarc(entries, filename, jobs, level)
+
+
+def file_digest(fullpath):
+    """MD5 of a file, read block by block"""
+    digest = hashlib.md5()
+    with open(fullpath, 'rb') as fstream:
+        for raw in iter(lambda: fstream.read(BLOCK_SIZE), b''):
+            digest.update(raw)
+    return digest.digest()
+
+
+def unchanged_entries(archive, files, digests=None):
+    """Entries of an archive whose content is the same as the file at the
+    same path. Returns a dictionary name -> entry. If a digests dictionary
+    is given, the digests of the files hashed are kept in it by name."""
+    if digests is None:
+        digests = {}
+    unchanged = {}
+    for name, fullpath in files:
+        entry = archive.paths.get(name)
+        if entry is None:
+            continue
+        if not is_encrypted(name) and \
+                entry['length'] != os.path.getsize(fullpath):
+            continue
+        # Hashed block by block, SNGs are encrypted as a whole
+        digest = hashlib.md5()
+        if is_encrypted(name):
+            digest.update(archive.read(entry))
+        else:
+            for idx in range(len(entry['zlength'])):
+                digest.update(archive.read_block(entry, idx))
+        digests[name] = file_digest(fullpath)
+        if digest.digest() == digests[name]:
+            unchanged[name] = entry
+    return unchanged
+
+
+def pack_directory(path, filename, jobs=1, level=zlib.Z_BEST_COMPRESSION,
+                   log=stdout_same_line, previous=None, dedup=False,
+                   adaptive=None):
+    """Stream a directory to a PSARC file. Files are read and compressed
+    block by block straight into the output, after a region reserved for the
+    TOC which is written last. Memory use does not depend on the size of
+    other files, SNGs are encrypted whole up front to know their length and
+    are spooled to a temporary file until written.
+
+    With a previous archive, which may be the output file itself, the stored
+    blocks of entries whose content did not change are copied from it and
+    only new or modified files are compressed.
+
+    With dedup, files with identical content are compressed once and share a
+    single data region and zindex range in the TOC.
+
+    With an AdaptiveDeflate, blocks are compressed by it instead.
+
+    Returns a dictionary of statistics: entries, reused entries, and
+    deduplicated entries, bytes and stored bytes."""
+    # Order is reversed
+    files = sorted(walk_directory(path), reverse=True)
+    listing = '\n'.join(name for name, _ in files).encode('utf-8')
+
+    old = PsarcArchive(previous) if previous else None
+    # The previous archive is still being read, write next to it
+    outname = filename + '.tmp' if old else filename
+    spool = tempfile.TemporaryFile()
+    try:
+        # Files are hashed at most once, by the first pass needing them
+        digests = {}
+        reused = unchanged_entries(old, files, digests) if old else {}
+
+        # Lengths, and duplicates, are needed up front to reserve the TOC
+        lengths = [len(listing)]
+        prepared = {}
+        holders = {}
+        shared = {}
+        for name, fullpath in files:
+            data = None
+            if name in reused:
+                lengths.append(reused[name]['length'])
+            elif is_encrypted(name):
+                with open(fullpath, 'rb') as fstream:
+                    data = prepare_entry(name, fstream.read(), level)
+                lengths.append(len(data))
+            else:
+                lengths.append(os.path.getsize(fullpath))
+
+            if dedup:
+                # Same content and same SNG key give the same stored blocks
+                if name not in digests:
+                    digests[name] = file_digest(fullpath)
+                key = (sng_key(name), lengths[-1], digests[name])
+                if key in holders:
+                    shared[name] = holders[key]
+                    continue
+                holders[key] = name
+
+            if data is not None:
+                prepared[name] = spool.tell()
+                spool.write(data)
+        spool.flush()
+
+        def blocks():
+            """Raw blocks, and whether adaptive packing stores them as is"""
+            for i in range(0, len(listing), BLOCK_SIZE):
+                yield listing[i:i + BLOCK_SIZE], False
+
+            for (name, fullpath), length in zip(files, lengths[1:]):
+                if name in reused or name in shared:
+                    continue
+
+                if name in prepared:
+                    position = prepared[name]
+                    for i in range(0, length, BLOCK_SIZE):
+                        yield read_at(spool, position + i,
+                                      min(BLOCK_SIZE, length - i)), False
+                    continue
+
+                with open(fullpath, 'rb') as fstream:
+                    store = adaptive is not None and stored_extension(name)
+                    remaining = length
+                    while remaining > 0:
+                        raw = fstream.read(min(BLOCK_SIZE, remaining))
+                        if not raw:
+                            raise IOError(fullpath + ' changed while packing')
+                        remaining -= len(raw)
+                        yield raw, store
+
+        names = [''] + [name for name, _ in files]
+        n_blocks = sum(block_count(length)
+                       for name, length in zip(names, lengths)
+                       if name not in shared)
+        stats = {
+            'entries': len(files),
+            'reused': len(reused),
+            'deduplicated': len(shared),
+            'deduplicated_bytes': 0,
+            'deduplicated_stored': 0
+        }
+
+        entries = []
+        by_name = {}
+        logmsg = 'Creating ' + filename + ' {0}/' + str(len(files))
+        if reused:
+            logmsg += ', ' + str(len(reused)) + ' reused'
+        with open(outname, 'wb') as fstream:
+            fstream.seek(toc_size(len(names), n_blocks))
+
+            if adaptive is None:
+                deflate = lambda block: deflate_block(block[0], level)
+            else:
+                deflate = lambda block: adaptive(*block)
+            deflated = bounded_map(deflate, blocks(), jobs)
+            offset = 0
+            zindex = 0
+            for idx, (name, length) in enumerate(zip(names, lengths)):
+                if idx > 0 and log:
+                    log(logmsg.format(idx))
+
+                entry = {
+                    'filepath': name,
+                    'zlength': [],
+                    'length': length,
+                    'offset': offset,
+                    'zindex': zindex,
+                    'md5': name_hash(name)
+                }
+                if name in shared:
+                    holder = by_name[shared[name]]
+                    entry['offset'] = holder['offset']
+                    entry['zindex'] = holder['zindex']
+                    entry['zlength'] = holder['zlength']
+                    stats['deduplicated_bytes'] += length
+                    stats['deduplicated_stored'] += stored_size(holder)
+                    entries.append(entry)
+                    continue
+                elif name in reused:
+                    with old.stored(reused[name]) as buf:
+                        fstream.write(buf)
+                        offset += len(buf)
+                    entry['zlength'] = list(reused[name]['zlength'])
+                else:
+                    for _ in range(block_count(length)):
+                        chunk, zlength = next(deflated)
+                        fstream.write(chunk)
+                        offset += len(chunk)
+                        entry['zlength'].append(zlength)
+                zindex += len(entry['zlength'])
+                entries.append(entry)
+                by_name[name] = entry
+
+            fstream.seek(0)
+            fstream.write(encode_toc(entries))
+    except BaseException:
+        if old and os.path.exists(outname):
+            os.remove(outname)
+        raise
+    finally:
+        spool.close()
+        if old:
+            old.close()
+
+    if old:
+        os.replace(outname, filename)
+
+    return stats
+
+
 def change_path(data, osx2pc):
     """Changing path"""
     if osx2pc:
@@ -358,11 +1618,17 @@ def change_path(data, osx2pc):
     return data
 
 
-# TODO logic for converting needs cleanup
-def convert(filename):
-    """Convert between PC and Mac PSARC"""
-    content = {}
+def convert(filename, jobs=1, level=zlib.Z_BEST_COMPRESSION):
+    """Convert between PC and Mac PSARC. Only SNGs, which are encrypted with
+    a platform key, and aggregategraph.nt are decoded and recompressed, the
+    stored blocks of other entries are copied as is.
 
+    The entries which are recompressed are the only ones changing length,
+    they are transformed first so that the region of the TOC can be
+    reserved. Entries then flow through a pipeline where block compression
+    and writing run concurrently, each stage holding a few items per job,
+    straight into the output, and the TOC is written last. Stored data of
+    copied entries is moved by copy_range, in the kernel where possible."""
     osx2pc = False
     outname = filename
     if filename.endswith('_m.psarc'):
@@ -371,34 +1637,229 @@ def convert(filename):
     else:
         outname = filename.replace('_p.psarc', '_m.psarc')
 
-    with open(filename, 'rb') as psarc:
-        entries = read_toc(psarc)
-        for entry in entries:
-            data = read_entry(psarc, entry)
-
-            if entry['filepath'].endswith('aggregategraph.nt'):
-                data = change_path(data, osx2pc)
-                if osx2pc:
-                    data = data.replace('macos', 'dx9')
-                else:
-                    data = data.replace('dx9', 'macos')
-
-            content[change_path(entry['filepath'], osx2pc)] = data
-
-    create_psarc(content, outname)
+    with PsarcArchive(filename) as psarc:
+        # Order is reversed, on the new paths
+        items = sorted(((change_path(entry['filepath'], osx2pc), entry)
+                        for entry in psarc), key=lambda item: item[0],
+                       reverse=True)
+
+        def transform(item):
+            """New content of an entry which is recompressed"""
+            filepath, entry = item
+            if is_encrypted(entry['filepath']):
+                # Already on the pool, a worker must not wait on it
+                return prepare_entry(filepath, psarc.read(entry), level)
+            data = change_path(psarc.read(entry).decode('utf-8'), osx2pc)
+            if osx2pc:
+                data = data.replace('macos', 'dx9')
+            else:
+                data = data.replace('dx9', 'macos')
+            return data.encode('utf-8')
+
+        changed = [item for item in items
+                   if is_encrypted(item[1]['filepath']) or
+                   item[1]['filepath'].endswith('aggregategraph.nt')]
+        prepared = {filepath: data for (filepath, _), data in
+                    zip(changed, bounded_map(transform, changed, jobs))}
+        prepared[''] = '\n'.join(filepath for filepath, _ in items) \
+            .encode('utf-8')
+        items.insert(0, ('', None))
+
+        # Length of every entry and its number of items: raw blocks, or the
+        # region of stored data copied as is
+        layout = []
+        n_blocks = 0
+        for filepath, entry in items:
+            if filepath in prepared:
+                length = len(prepared[filepath])
+                layout.append((filepath, length, block_count(length)))
+                n_blocks += block_count(length)
+            else:
+                layout.append((filepath, entry['length'], 1))
+                n_blocks += len(entry['zlength'])
+
+        def blocks():
+            """Raw blocks of recompressed entries, and the stored data of
+            copied ones as a (position, size) pair with its zlengths"""
+            for filepath, entry in items:
+                if filepath not in prepared:
+                    region = (entry['offset'], stored_size(entry))
+                    yield region, entry['zlength']
+                    continue
+                view = memoryview(prepared.pop(filepath))
+                for i in range(0, len(view), BLOCK_SIZE):
+                    yield view[i:i + BLOCK_SIZE]
+
+        def deflate(item):
+            if isinstance(item, memoryview):
+                chunk, zlength = deflate_block(item, level)
+                return chunk, [zlength]
+            return item
+
+        entries = []
+        offset = 0
+        zindex = 0
+        deflated = bounded_map(deflate, blocks(), jobs)
+        try:
+            with open(outname, 'wb', buffering=0) as fstream, \
+                    open(filename, 'rb') as source, \
+                    ThreadPoolExecutor(1) as writer:
+                fd = fstream.fileno()
+                fstream.seek(toc_size(len(layout), n_blocks))
+                written = collections.deque()
+                for filepath, length, n_items in layout:
+                    entry = {
+                        'filepath': filepath,
+                        'zlength': [],
+                        'length': length,
+                        'offset': offset,
+                        'zindex': zindex,
+                        'md5': name_hash(filepath)
+                    }
+                    for _ in range(n_items):
+                        chunk, zlength = next(deflated)
+                        if isinstance(chunk, tuple):
+                            position, size = chunk
+                            written.append(writer.submit(
+                                copy_range, source.fileno(), position, fd,
+                                size))
+                        else:
+                            size = len(chunk)
+                            written.append(writer.submit(write_all, fd,
+                                                         chunk))
+                        if len(written) >= 4 * jobs:
+                            written.popleft().result()
+                        offset += size
+                        entry['zlength'] += zlength
+                    zindex += len(entry['zlength'])
+                    entries.append(entry)
+                while written:
+                    written.popleft().result()
+
+                fstream.seek(0)
+                write_all(fd, encode_toc(entries))
+        except BaseException:
+            if os.path.exists(outname):
+                os.remove(outname)
+            raise
 
 
 if __name__ == '__main__':
     from docopt import docopt
     args = docopt(__doc__)
 
+    jobs = int(args['--jobs'])
+    if args['--compression'] not in PROFILES:
+        sys.exit('Unknown compression profile ' + args['--compression'])
+    level = PROFILES[args['--compression']]
+
     if args['unpack']:
-        for f in args['FILE']:
-            extract_psarc(f)
+        processes = int(args['--processes'])
+        include, exclude = args['--include'], args['--exclude']
+        if args['--stats'] not in (None, 'json'):
+            sys.exit('Unknown statistics format ' + args['--stats'])
+        report = {} if args['--stats'] else None
+        preallocate = args['--preallocate']
+
+        failed = []
+        if processes > 1:
+            failed = extract_batch(args['FILE'], processes, jobs,
+                                   include, exclude, report, preallocate)
+        else:
+            for f in args['FILE']:
+                if report is None:
+                    extract_psarc(f, jobs, include=include, exclude=exclude,
+                                  preallocate=preallocate)
+                else:
+                    report[f] = extract_with_stats(f, jobs, include, exclude,
+                                                   preallocate)[2]
+
+        if report is not None:
+            print(json.dumps(report, indent=2, sort_keys=True))
+        if failed:
+            sys.exit(1)
     elif args['pack']:
         for d in args['DIRECTORY']:
             d = os.path.normpath(d)
-            create_psarc(path2dict(d), d + '.psarc')
+            previous = None
+            if args['--incremental'] and os.path.exists(d + '.psarc'):
+                previous = d + '.psarc'
+            adaptive = AdaptiveDeflate(level) if args['--adaptive'] else None
+            stats = pack_directory(d, d + '.psarc', jobs, level,
+                                   previous=previous, dedup=args['--dedup'],
+                                   adaptive=adaptive)
+            if stats['deduplicated']:
+                print('\nDeduplicated {0} entries, {1:.1f} MB ({2:.1f} MB '
+                      'stored)'.format(stats['deduplicated'],
+                                       stats['deduplicated_bytes'] / 1e6,
+                                       stats['deduplicated_stored'] / 1e6))
+            if adaptive:
+                skipped = adaptive.stats()
+                print('\nStored {0}/{1} blocks ({2:.1f} MB) without '
+                      'compressing them, about {3:.2f} s of CPU skipped for '
+                      '{4:.2f} s of trials'.format(
+                          skipped['skipped'], skipped['blocks'],
+                          skipped['skipped_bytes'] / 1e6,
+                          skipped['skipped_seconds'],
+                          skipped['trial_seconds']))
     elif args['convert']:
         for f in args['FILE']:
-            convert(f)
+            convert(f, jobs, level)
+    elif args['ls']:
+        for f in args['FILE']:
+            with PsarcArchive(f) as psarc:
+                print('{0:>12} {1:>12} {2:>6}  {3}'.format(
+                    'length', 'stored', 'ratio', f))
+                for entry in psarc:
+                    stored = stored_size(entry)
+                    print('{0:>12} {1:>12} {2:>6.3f}  {3}'.format(
+                        entry['length'], stored,
+                        stored / max(entry['length'], 1), entry['filepath']))
+    elif args['stat']:
+        for f in args['FILE']:
+            with PsarcArchive(f) as psarc:
+                stats = toc_stats(psarc.entries)
+            print('{0}: {1} entries, {2} blocks ({3} raw), {4:.1f} MB stored '
+                  'as {5:.1f} MB ({6:.3f})'.format(
+                      f, stats['entries'], stats['blocks'],
+                      stats['raw_blocks'], stats['length'] / 1e6,
+                      stats['stored'] / 1e6,
+                      stats['stored'] / max(stats['length'], 1)))
+    elif args['verify']:
+        failed = False
+        for f in args['FILE']:
+            start = time.time()
+            try:
+                problems, inflated = verify_psarc(f, jobs)
+            except Exception as e:
+                problems, inflated = [('', str(e))], 0
+            elapsed = max(time.time() - start, 1e-6)
+
+            for filepath, problem in problems:
+                print(f + ': ' + filepath + ': ' + problem)
+            print('{0}: {1}, {2:.1f} MB in {3:.2f} s ({4:.1f} MB/s)'.format(
+                f, 'FAILED' if problems else 'OK', inflated / 1e6, elapsed,
+                inflated / elapsed / 1e6))
+            failed = failed or bool(problems)
+        if failed:
+            sys.exit(1)
+    elif args['diff']:
+        notes = {}
+        added, removed, modified = diff_psarc(*args['FILE'], jobs=jobs,
+                                              notes=notes)
+        for filepath in added:
+            print('+ ' + filepath)
+        for filepath in removed:
+            print('- ' + filepath)
+        for filepath in modified:
+            if filepath in notes:
+                print('M ' + filepath + ' (unreadable: ' + notes[filepath] +
+                      ')')
+            else:
+                print('M ' + filepath)
+        if added or removed or modified:
+            sys.exit(1)
+    elif args['serve']:
+        import psarcserve
+        psarcserve.serve(args['DIR'], int(args['--port']),
+                         int(args['--cache']) * 1024 * 1024)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks for psarc.py.
+
+Usage:
+    psarcbench.py profiles [--jobs N] DIRECTORY...
+    psarcbench.py suite [--jobs N] [--entries N] [--size BYTES]
+                        [--compressibility RATIO] [--sngs N] [--repeat N]
+                        [--seed N] [--output FILE]
+    psarcbench.py stress [--threads N] [--reads N] [--entries N] [--size BYTES]
+                         [--seed N]
+
+Options:
+    -j N, --jobs N             Number of worker threads [default: 1]
+    --entries N                Number of synthetic entries [default: 50]
+    --size BYTES               Size of each entry [default: 1000000]
+    --compressibility RATIO    Compressible share of each entry [default: 0.5]
+    --sngs N                   Number of encrypted SNG entries [default: 5]
+    --repeat N                 Runs of each benchmark, best is kept [default: 3]
+    --seed N                   Seed of the synthetic data [default: 0]
+    -o FILE, --output FILE     Write JSON results to FILE instead of stdout
+    --threads N                Reader threads of the stress test [default: 8]
+    --reads N                  Reads per thread [default: 200]
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psarc
+
+
+def bench_profiles(path, jobs=1):
+    """Pack a directory with every compression profile, and adaptively with
+    the best one. Returns a list of (profile, seconds, size) sorted from the
+    smallest archive."""
+    results = []
+    fd, filename = tempfile.mkstemp(suffix='.psarc')
+    os.close(fd)
+    try:
+        for profile, level in psarc.PROFILES.items():
+            start = time.time()
+            psarc.pack_directory(path, filename, jobs, level, None)
+            elapsed = time.time() - start
+            results.append((profile, elapsed, os.path.getsize(filename)))
+
+        start = time.time()
+        psarc.pack_directory(path, filename, jobs, psarc.PROFILES['best'],
+                             None, adaptive=psarc.AdaptiveDeflate())
+        elapsed = time.time() - start
+        results.append(('adaptive', elapsed, os.path.getsize(filename)))
+    finally:
+        os.remove(filename)
+
+    return sorted(results, key=lambda result: result[2])
+
+
+def print_profiles(path, results):
+    """Size against time table"""
+    raw = sum(os.path.getsize(fullpath)
+              for _, fullpath in psarc.walk_directory(path))
+
+    print('\n' + path + ' ({0:.1f} MB)'.format(raw / 1e6))
+    print('{0:<8} {1:>9} {2:>11} {3:>7} {4:>9}'.format(
+        'profile', 'time (s)', 'size (MB)', 'ratio', 'MB/s'))
+    for profile, elapsed, size in results:
+        print('{0:<8} {1:>9.2f} {2:>11.2f} {3:>7.3f} {4:>9.1f}'.format(
+            profile, elapsed, size / 1e6, size / max(raw, 1),
+            raw / max(elapsed, 1e-6) / 1e6))
+
+
+def synthetic_data(rng, size, compressibility):
+    """Bytes of which a given share is a repeated pattern, the rest random"""
+    compressible = int(size * compressibility)
+    pattern = rng.randbytes(64)
+    data = pattern * (compressible // 64 + 1)
+    return data[:compressible] + rng.randbytes(size - compressible)
+
+
+def synthetic_files(entries=50, size=1000000, compressibility=0.5, sngs=5,
+                    seed=0):
+    """Dictionary filepath -> data looking like a PC song pack: WEM audio,
+    encrypted SNGs, a manifest per SNG and an aggregate graph"""
+    rng = random.Random(seed)
+    files = {}
+
+    for _ in range(entries):
+        name = 'audio/windows/{0:08x}.wem'.format(rng.getrandbits(32))
+        files[name] = synthetic_data(rng, size, compressibility)
+
+    for idx in range(sngs):
+        name = 'song{0}_lead'.format(idx)
+        # SNGs are highly structured, they compress well
+        files['songs/bin/generic/' + name + '.sng'] = \
+            synthetic_data(rng, size // 4, 0.9)
+        files['manifests/songs/' + name + '.json'] = json.dumps(
+            {'Entries': {name: {'Attributes': {'Tones': [name]}}}}).encode()
+
+    files['songs.aggregategraph.nt'] = \
+        '\n'.join(sorted(files)).encode('utf-8')
+    return files
+
+
+def best_time(function, repeat=3):
+    """Best wall time of a few runs"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def git_commit():
+    """Commit of the checkout running the benchmark, if any"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(files, jobs=1, repeat=3):
+    """Time the hot paths of psarc on a synthetic archive. Returns a
+    dictionary of benchmark -> seconds and MB/s of uncompressed data."""
+    raw = sum(len(data) for data in files.values())
+    results = {}
+
+    def record(name, function):
+        seconds = best_time(function, repeat)
+        results[name] = {
+            'seconds': seconds,
+            'mb_per_s': raw / max(seconds, 1e-9) / 1e6
+        }
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        filename = 'bench_p.psarc'
+
+        record('create_psarc', lambda: psarc.create_psarc(
+            files, filename, jobs, log=None))
+
+        def read_toc():
+            with open(filename, 'rb') as fstream:
+                return psarc.read_toc(fstream)
+
+        record('read_toc', read_toc)
+        entries = read_toc()
+
+        def read_entries():
+            with open(filename, 'rb') as fstream:
+                for entry in entries:
+                    psarc.read_entry(fstream, entry, jobs)
+
+        record('read_entry', read_entries)
+
+        def extract():
+            psarc.extract_psarc(filename, jobs, log=None)
+            shutil.rmtree('bench_p')
+
+        record('extract_psarc', extract)
+        record('convert', lambda: psarc.convert(filename, jobs))
+
+        results['archive_size'] = os.path.getsize(filename)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+    results['raw_size'] = raw
+    return results
+
+
+def stress_reads(files, threads=8, reads=200, seed=0):
+    """Read random entries and ranges of a synthetic archive from many
+    threads at once, all sharing one open file and one PsarcArchive, and
+    check every result against the original data. Returns a dictionary of
+    reader -> reads, errors (wrong data or exceptions) and seconds."""
+    results = {}
+    names = sorted(files)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, 'stress_p.psarc')
+        psarc.create_psarc(files, filename, threads,
+                           psarc.PROFILES['fast'], None)
+
+        with open(filename, 'rb') as fstream, \
+                psarc.PsarcArchive(filename) as archive:
+            entries = {entry['filepath']: entry
+                       for entry in psarc.read_toc(fstream)}
+
+            readers = {
+                'read_entry': lambda name, start, length: psarc.read_entry(
+                    fstream, entries[name]),
+                'read_entry_range': lambda name, start, length:
+                    psarc.read_entry_range(fstream, entries[name],
+                                           start, length),
+                'PsarcArchive.read': lambda name, start, length:
+                    archive.read(name),
+                'PsarcArchive.read_range': lambda name, start, length:
+                    archive.read_range(name, start, length)
+            }
+
+            for reader, function in readers.items():
+                ranged = reader.endswith('range')
+                barrier = threading.Barrier(threads)
+                errors = []
+
+                def worker(idx):
+                    rng = random.Random(seed * threads + idx)
+                    barrier.wait()
+                    for _ in range(reads):
+                        name = rng.choice(names)
+                        data = files[name]
+                        start = rng.randrange(len(data) + 1)
+                        length = rng.randrange(3 * psarc.BLOCK_SIZE)
+                        expected = data[start:start + length] if ranged \
+                            else data
+                        try:
+                            if function(name, start, length) != expected:
+                                errors.append((name, start, length))
+                        except Exception:
+                            errors.append((name, start, length))
+
+                start = time.perf_counter()
+                workers = [threading.Thread(target=worker, args=(idx,))
+                           for idx in range(threads)]
+                for thread in workers:
+                    thread.start()
+                for thread in workers:
+                    thread.join()
+
+                results[reader] = {
+                    'reads': threads * reads,
+                    'errors': len(errors),
+                    'seconds': time.perf_counter() - start
+                }
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return results
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    jobs = int(args['--jobs'])
+
+    if args['profiles']:
+        for d in args['DIRECTORY']:
+            d = os.path.normpath(d)
+            print_profiles(d, bench_profiles(d, jobs))
+    elif args['suite']:
+        params = {
+            'entries': int(args['--entries']),
+            'size': int(args['--size']),
+            'compressibility': float(args['--compressibility']),
+            'sngs': int(args['--sngs']),
+            'seed': int(args['--seed'])
+        }
+        files = synthetic_files(**params)
+        params['jobs'] = jobs
+        params['repeat'] = int(args['--repeat'])
+
+        report = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'params': params,
+            'results': bench_suite(files, jobs, params['repeat'])
+        }
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if args['--output']:
+            with open(args['--output'], 'w') as fstream:
+                fstream.write(output + '\n')
+        else:
+            print(output)
+    elif args['stress']:
+        files = synthetic_files(int(args['--entries']), int(args['--size']),
+                                seed=int(args['--seed']))
+        results = stress_reads(files, int(args['--threads']),
+                               int(args['--reads']), int(args['--seed']))
+
+        failed = False
+        for reader, result in results.items():
+            print('{0:<24} {1:>6} reads {2:>8.2f} s {3:>6} errors'.format(
+                reader, result['reads'], result['seconds'], result['errors']))
+            failed = failed or result['errors'] > 0
+        if failed:
+            sys.exit(1)
@@ -0,0 +1,190 @@
+"""
+Read-only, zipfile-like access to the content of a PSARC archive.
+
+    with PsarcFS('song_p.psarc') as fs:
+        for dirpath, dirnames, filenames in fs.walk('.'):
+            ...
+        with fs.open('manifests/songs/song.json', 'r') as fstream:
+            manifest = json.load(fstream)
+
+Files are decompressed lazily, one 64 KiB block at a time as they are read,
+so tools written against os.walk and open can run on an archive with no
+staging directory, e.g. xgraph.run('.', fs.walk).
+"""
+
+import io
+import posixpath
+
+import psarc
+
+
+class PsarcFile(io.RawIOBase):
+    """Seekable, read-only file object over one entry"""
+
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+        self.position = 0
+        self.current = (None, b'')
+
+        # SNGs are encrypted as a whole and can only be decoded entirely
+        self.data = None
+        if psarc.is_encrypted(entry['filepath']):
+            self.data = archive.read(entry)
+        self.length = entry['length'] if self.data is None else len(self.data)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError('negative seek position ' + str(offset))
+        self.position = offset
+        return offset
+
+    def block(self, idx):
+        """Inflated block, the last one read is kept"""
+        if self.current[0] != idx:
+            if self.data is None:
+                data = self.archive.read_block(self.entry, idx)
+            else:
+                start = idx * psarc.BLOCK_SIZE
+                data = self.data[start:start + psarc.BLOCK_SIZE]
+            self.current = (idx, data)
+        return self.current[1]
+
+    def readinto(self, buf):
+        if self.position >= self.length or len(buf) == 0:
+            return 0
+
+        idx = self.position // psarc.BLOCK_SIZE
+        data = self.block(idx)
+        start = self.position - idx * psarc.BLOCK_SIZE
+        size = min(len(buf), len(data) - start)
+        memoryview(buf)[:size] = data[start:start + size]
+        self.position += size
+        return size
+
+
+class PsarcFS:
+    """Directory tree of a PSARC. Paths use / and are relative to the root
+    of the archive, '' and '.' being the root itself."""
+
+    def __init__(self, archive):
+        self.owned = not isinstance(archive, psarc.PsarcArchive)
+        self.archive = psarc.PsarcArchive(archive) if self.owned else archive
+        # Decoded lengths of SNGs, which differ from the stored lengths
+        self.sizes = {}
+
+        self.dirs = {'': set()}
+        for entry in self.archive:
+            parent = posixpath.dirname(entry['filepath'])
+            self.dirs[parent] = self.dirs.get(parent, set())
+            self.dirs[parent].add(posixpath.basename(entry['filepath']))
+            while parent:
+                grandparent = posixpath.dirname(parent)
+                self.dirs.setdefault(grandparent, set()).add(
+                    posixpath.basename(parent))
+                parent = grandparent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close the archive if it was opened here"""
+        if self.owned:
+            self.archive.close()
+
+    @staticmethod
+    def normpath(path):
+        """Path relative to the root"""
+        path = posixpath.normpath(path.replace('\\', '/')).strip('/')
+        return '' if path == '.' else path
+
+    def exists(self, path):
+        path = self.normpath(path)
+        return path in self.dirs or path in self.archive
+
+    def isdir(self, path):
+        return self.normpath(path) in self.dirs
+
+    def isfile(self, path):
+        return self.normpath(path) in self.archive
+
+    def listdir(self, path=''):
+        """Names of the files and folders of a folder"""
+        path = self.normpath(path)
+        if path not in self.dirs:
+            raise FileNotFoundError(path)
+        return sorted(self.dirs[path])
+
+    def stat(self, path):
+        """Dictionary with name, type ('file' or 'directory'), size and, for
+        files, the size stored in the archive. The size is the one read from
+        the file, SNGs are decoded once to know it."""
+        path = self.normpath(path)
+        if path in self.archive:
+            entry = self.archive[path]
+            size = entry['length']
+            if psarc.is_encrypted(path):
+                if path not in self.sizes:
+                    self.sizes[path] = len(self.archive.read(entry))
+                size = self.sizes[path]
+            return {
+                'name': path,
+                'type': 'file',
+                'size': size,
+                'stored': psarc.stored_size(entry)
+            }
+        if path in self.dirs:
+            return {'name': path, 'type': 'directory', 'size': 0}
+        raise FileNotFoundError(path)
+
+    def walk(self, top='.'):
+        """Like os.walk, dirpath is top joined with the folder path"""
+        root = self.normpath(top)
+        if root not in self.dirs:
+            return
+
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            dirnames, filenames = [], []
+            for name in sorted(self.dirs[path]):
+                child = posixpath.join(path, name)
+                (dirnames if child in self.dirs else filenames).append(name)
+
+            dirpath = top if path == root else \
+                posixpath.join(top, path[len(root):].lstrip('/'))
+            yield dirpath, dirnames, filenames
+
+            stack += [posixpath.join(path, name)
+                      for name in reversed(dirnames)]
+
+    def open(self, path, mode='rb', encoding='utf-8'):
+        """Open a file for reading, in binary ('rb') or text ('r') mode"""
+        if mode not in ('r', 'rb'):
+            raise ValueError('PSARC files are read-only')
+
+        path = self.normpath(path)
+        if path not in self.archive:
+            raise FileNotFoundError(path)
+
+        raw = PsarcFile(self.archive, self.archive[path])
+        fstream = io.BufferedReader(raw, psarc.BLOCK_SIZE)
+        if mode == 'r':
+            return io.TextIOWrapper(fstream, encoding)
+        return fstream
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""
+Persistent TOC index for a library of PSARC archives.
+
+Usage:
+    psarcindex.py scan INDEX FILE...
+    psarcindex.py find INDEX GLOB
+"""
+
+import os
+import sqlite3
+import struct
+import sys
+
+import psarc
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    archive INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    filepath TEXT NOT NULL,
+    md5 BLOB NOT NULL,
+    zindex INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    zlength BLOB NOT NULL,
+    PRIMARY KEY (archive, idx)
+);
+CREATE INDEX IF NOT EXISTS entries_filepath ON entries(filepath);
+"""
+
+
+def encode_zlength(zlength):
+    """Block sizes as a BLOB"""
+    return struct.pack('>%dH' % len(zlength), *zlength)
+
+
+def decode_zlength(blob):
+    """Block sizes from a BLOB"""
+    return list(struct.unpack('>%dH' % (len(blob) // 2), blob))
+
+
+class PsarcIndex:
+    """SQLite cache of decoded PSARC TOCs. Archives are keyed by absolute
+    path, size and mtime, and only rescanned when one of them changes."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Commit and close the database"""
+        self.db.commit()
+        self.db.close()
+
+    def lookup(self, filename):
+        """Archive id of an up to date archive, or None"""
+        st = os.stat(filename)
+        row = self.db.execute(
+            'SELECT id FROM archives WHERE path = ? AND size = ? AND mtime = ?',
+            (os.path.abspath(filename), st.st_size, st.st_mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def update(self, filename):
+        """Scan an archive if it is new or changed. Returns True if the TOC
+        had to be decoded."""
+        if self.lookup(filename) is not None:
+            return False
+
+        st = os.stat(filename)
+        path = os.path.abspath(filename)
+        with open(filename, 'rb') as fstream:
+            entries = psarc.read_toc(fstream)
+
+        with self.db:
+            self.db.execute('DELETE FROM archives WHERE path = ?', (path,))
+            archive = self.db.execute(
+                'INSERT INTO archives (path, size, mtime) VALUES (?, ?, ?)',
+                (path, st.st_size, st.st_mtime_ns)).lastrowid
+            self.db.executemany(
+                'INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(archive, idx, entry['filepath'], entry['md5'],
+                  entry['zindex'], entry['length'], entry['offset'],
+                  encode_zlength(entry['zlength']))
+                 for idx, entry in enumerate(entries)])
+        return True
+
+    def scan(self, filenames, log=psarc.stdout_same_line):
+        """Bring the index up to date for a list of archives. Returns the
+        number of archives that were rescanned."""
+        rescanned = 0
+        for idx, filename in enumerate(filenames):
+            rescanned += self.update(filename)
+            if log:
+                log('Indexed {0}/{1}, {2} rescanned'.format(
+                    idx + 1, len(filenames), rescanned))
+        return rescanned
+
+    def entries(self, filename):
+        """Decoded TOC of an archive, as returned by psarc.read_toc"""
+        self.update(filename)
+        rows = self.db.execute(
+            'SELECT filepath, md5, zindex, length, offset, zlength '
+            'FROM entries WHERE archive = ? ORDER BY idx',
+            (self.lookup(filename),))
+        return [{
+            'filepath': filepath,
+            'md5': bytes(md5),
+            'zindex': zindex,
+            'length': length,
+            'offset': offset,
+            'zlength': decode_zlength(zlength)
+        } for filepath, md5, zindex, length, offset, zlength in rows]
+
+    def open(self, filename):
+        """PsarcArchive of an archive, without decoding its TOC again"""
+        return psarc.PsarcArchive(filename, self.entries(filename))
+
+    def find(self, pattern):
+        """Yields (archive path, entry path) for entries matching a glob"""
+        regex = psarc.glob_regex(pattern)
+        rows = self.db.execute(
+            'SELECT archives.path, entries.filepath FROM entries '
+            'JOIN archives ON archives.id = entries.archive '
+            'ORDER BY archives.path, entries.idx')
+        for path, filepath in rows:
+            if regex.match(filepath):
+                yield path, filepath
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__)
+
+    with PsarcIndex(args['INDEX']) as index:
+        if args['scan']:
+            index.scan(args['FILE'])
+            sys.stdout.write('\n')
+        elif args['find']:
+            for path, filepath in index.find(args['GLOB']):
+                print(path + ':' + filepath)
@@ -0,0 +1,317 @@
+"""
+Local HTTP server for the entries of PSARC archives, started with
+`psarc.py serve DIR`.
+
+GET /<archive>/<entry path> returns the content of an entry, and
+GET /<archive> a JSON listing of its entries. Range requests only inflate
+the 64 KiB blocks covering the requested bytes, decoded blocks are kept in
+a bounded LRU cache and archives stay open between requests.
+"""
+
+import asyncio
+import collections
+import functools
+import json
+import mimetypes
+import os
+import re
+import struct
+import sys
+import threading
+import urllib.parse
+
+import psarc
+
+MAX_OPEN_ARCHIVES = 64
+
+RANGE = re.compile(r'bytes=(\d*)-(\d*)\Z')
+
+REASONS = {
+    200: 'OK',
+    206: 'Partial Content',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    500: 'Internal Server Error'
+}
+
+
+class ResponseAborted(Exception):
+    """A response failed after its headers were sent"""
+
+
+class LRUCache:
+    """Thread safe LRU mapping bounded by the total size of its values"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.capacity and self.items:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class ArchiveServer:
+    """Serves the entries of the archives found below a directory"""
+
+    def __init__(self, root, cache_size=64 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.blocks = LRUCache(cache_size)
+        self.archives = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def archive(self, name):
+        """Open archive for a path relative to the root, or None, also for
+        files which are not valid archives"""
+        fullpath = os.path.abspath(os.path.join(self.root, name))
+        if not fullpath.startswith(self.root + os.sep) or \
+                not os.path.isfile(fullpath):
+            return None
+
+        with self.lock:
+            if fullpath in self.archives:
+                self.archives.move_to_end(fullpath)
+                return self.archives[fullpath]
+
+            try:
+                archive = psarc.PsarcArchive(fullpath)
+            except (ValueError, struct.error, OSError):
+                return None
+            self.archives[fullpath] = archive
+            if len(self.archives) > MAX_OPEN_ARCHIVES:
+                _, evicted = self.archives.popitem(last=False)
+                evicted.close()
+            return archive
+
+    def resolve(self, path):
+        """Split a request path into (archive, entry path). The archive is
+        the first component ending with .psarc."""
+        parts = urllib.parse.unquote(path).strip('/').split('/')
+        for idx, part in enumerate(parts):
+            if part.endswith('.psarc'):
+                archive = self.archive('/'.join(parts[:idx + 1]))
+                return archive, '/'.join(parts[idx + 1:])
+        return None, ''
+
+    def block(self, archive, entry, idx):
+        """Inflated block of an entry, through the cache"""
+        key = (archive.filename, entry['filepath'], idx)
+        data = self.blocks.get(key)
+        if data is None:
+            data = archive.read_block(entry, idx)
+            self.blocks.put(key, data)
+        return data
+
+    def decoded(self, archive, entry):
+        """Decoded content of an SNG, through the cache. SNGs are encrypted
+        as a whole and are decoded entirely."""
+        key = (archive.filename, entry['filepath'], None)
+        data = self.blocks.get(key)
+        if data is None:
+            data = bytes(archive.read(entry))
+            self.blocks.put(key, data)
+        return data
+
+    def read_range(self, archive, entry, start, end):
+        """Bytes [start, end) of an entry"""
+        return psarc.entry_range(
+            entry, start, end - start,
+            functools.partial(self.block, archive, entry),
+            functools.partial(self.decoded, archive, entry))
+
+    async def respond(self, writer, status, headers, body=b''):
+        """Write a response"""
+        lines = ['HTTP/1.1 {0} {1}'.format(status, REASONS[status])]
+        for name, value in headers.items():
+            lines.append('{0}: {1}'.format(name, value))
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if body:
+            writer.write(body)
+        await writer.drain()
+
+    async def error(self, writer, status, headers=None):
+        """Write an error response"""
+        body = REASONS[status].encode() + b'\n'
+        headers = dict(headers or {})
+        headers.update({'Content-Type': 'text/plain',
+                        'Content-Length': len(body)})
+        await self.respond(writer, status, headers, body)
+
+    async def handle_request(self, writer, method, path, headers):
+        """Serve one request"""
+        loop = asyncio.get_running_loop()
+
+        if method not in ('GET', 'HEAD'):
+            return await self.error(writer, 405, {'Allow': 'GET, HEAD'})
+
+        path = urllib.parse.urlsplit(path).path
+        archive, filepath = await loop.run_in_executor(
+            None, self.resolve, path)
+        if archive is None:
+            return await self.error(writer, 404)
+
+        if filepath == '':
+            listing = [{'filepath': entry['filepath'],
+                        'length': entry['length'],
+                        'stored': psarc.stored_size(entry)}
+                       for entry in archive]
+            body = json.dumps(listing, indent=2).encode('utf-8')
+            return await self.respond(writer, 200, {
+                'Content-Type': 'application/json',
+                'Content-Length': len(body)
+            }, body if method == 'GET' else b'')
+
+        if filepath not in archive:
+            return await self.error(writer, 404)
+        entry = archive[filepath]
+        if psarc.is_encrypted(entry['filepath']):
+            # Decoded once for the request, even when larger than the cache
+            content = await loop.run_in_executor(
+                None, self.decoded, archive, entry)
+            length = len(content)
+        else:
+            content = None
+            length = entry['length']
+
+        start, end, status = 0, length, 200
+        match = RANGE.match(headers.get('range', '').strip())
+        first, last = match.groups() if match else ('', '')
+        if first and last and int(last) < int(first):
+            # Invalid ranges are ignored, the whole entry is sent
+            first = last = ''
+        if first or last:
+            if first:
+                start = int(first)
+                if last:
+                    end = min(int(last) + 1, length)
+            else:
+                start = max(length - int(last), 0)
+            # Valid but past the end of the entry
+            if start >= end:
+                return await self.error(writer, 416, {
+                    'Content-Range': 'bytes */{0}'.format(length)})
+            status = 206
+
+        content_type = mimetypes.guess_type(filepath)[0] or \
+            'application/octet-stream'
+        response = {
+            'Content-Type': content_type,
+            'Content-Length': end - start,
+            'Accept-Ranges': 'bytes'
+        }
+        if status == 206:
+            response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                start, end - 1, length)
+        await self.respond(writer, status, response)
+
+        if method == 'HEAD':
+            return
+
+        # Stream a block at a time
+        position = start
+        while position < end:
+            chunk_end = min((position // psarc.BLOCK_SIZE + 1) *
+                            psarc.BLOCK_SIZE, end)
+            if content is not None:
+                data = content[position:chunk_end]
+            else:
+                try:
+                    data = await loop.run_in_executor(
+                        None, self.read_range, archive, entry, position,
+                        chunk_end)
+                except Exception as e:
+                    raise ResponseAborted(e) from e
+            writer.write(data)
+            await writer.drain()
+            position = chunk_end
+
+    async def handle_connection(self, reader, writer):
+        """Serve requests of a persistent connection"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, path, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.error(writer, 400)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    await self.handle_request(writer, method, path, headers)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except ResponseAborted as e:
+                    sys.stderr.write('{0}: {1}\n'.format(path, e))
+                    break
+                except Exception as e:
+                    sys.stderr.write('{0}: {1}\n'.format(path, e))
+                    await self.error(writer, 500)
+                    break
+
+                if version == 'HTTP/1.0' or \
+                        headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        """Close all open archives"""
+        with self.lock:
+            for archive in self.archives.values():
+                archive.close()
+            self.archives.clear()
+
+
+async def start_server(root, port=8080, cache_size=64 * 1024 * 1024,
+                       host='127.0.0.1'):
+    """Start serving a directory, returns the asyncio server and the
+    ArchiveServer"""
+    server = ArchiveServer(root, cache_size)
+    return await asyncio.start_server(
+        server.handle_connection, host, port), server
+
+
+def serve(root, port=8080, cache_size=64 * 1024 * 1024):
+    """Serve a directory until interrupted"""
+    async def main():
+        listener, server = await start_server(root, port, cache_size)
+        print('Serving ' + root + ' on http://127.0.0.1:' + str(port))
+        try:
+            async with listener:
+                await listener.serve_forever()
+        finally:
+            server.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -4,11 +4,15 @@
 Extracts tones from profile _prfldb files and .psarc files
 
 Usage:
-    tones.py FILES...
+    tones.py [--index FILE] FILES...
+
+Options:
+    --index FILE  Cache PSARC TOCs in a psarcindex database
 """
 
 import json
 import psarc
+import psarcindex
 
 
 def uniq_append(tones, ts):
@@ -17,20 +21,20 @@ def uniq_append(tones, ts):
             tones.append(tone)
 
 
-def from_psarc(filename):
+def from_psarc(filename, index=None):
     tones = []
 
-    with open(filename, 'rb') as stream:
-        entries = psarc.read_toc(stream)
-        for idx, entry in enumerate(entries):
+    archive = index.open(filename) if index else psarc.PsarcArchive(filename)
+    with archive:
+        for entry in archive:
             if not entry['filepath'].endswith('.json'):
                 continue
 
             try:
-                data = psarc.read_entry(stream, entry)
+                data = archive.read(entry)
                 x = json.loads(data)
                 if 'Entries' in x:
-                    for k, v in x['Entries'].iteritems():
+                    for k, v in x['Entries'].items():
                         e = v['Attributes']
                         if 'Tones' in e:
                             uniq_append(tones, e['Tones'])
@@ -61,11 +65,18 @@ if __name__ == '__main__':
     from docopt import docopt
     args = docopt(__doc__)
 
+    index = None
+    if args['--index']:
+        index = psarcindex.PsarcIndex(args['--index'])
+
     tones = []
     for f in args['FILES']:
         if f.endswith('.psarc'):
-            tones += from_psarc(f)
+            tones += from_psarc(f, index)
         elif f.endswith('_prfldb'):
             tones += from_profile(f)
 
-    print json.dumps(tones, indent=2)
+    if index:
+        index.close()
+
+    print(json.dumps(tones, indent=2))
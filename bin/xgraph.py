@@ -25,11 +25,11 @@ EXT_TEMPLATE = \
 <urn:uuid:%(uid)s> <http://emergent.net/aweb/1.0/logpath> "%(logpath)s".
 """
 
-def run(path):
+def run(path, walk=os.walk):
     output = ''
     path = os.path.normpath(path)
 
-    for dirpath, _, filenames in os.walk(path):
+    for dirpath, _, filenames in walk(path):
         dpath = dirpath[len(path):]
         for file in filenames:
             fname, ext = os.path.splitext(file)